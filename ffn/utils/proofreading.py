@@ -17,12 +17,15 @@
 
 import collections
 from collections import defaultdict
-import copy
-import itertools
+import contextlib
 import threading
 
-import networkx as nx
 import neuroglancer
+import numpy as np
+
+# Navigation requests arriving within this many seconds of each other are
+# coalesced into a single viewer update.
+NAVIGATION_DEBOUNCE_SEC = 0.03
 
 
 class Base:
@@ -34,14 +37,27 @@ class Base:
   The segmentation volume needs to be called `seg`.
   """
 
+  # Pairs of (Neuroglancer action name, name of the method handling it).
+  _ACTIONS = ()
+
   def __init__(self, num_to_prefetch: int = 10, locations=None, objects=None):
     self.viewer = neuroglancer.Viewer()
     self.num_to_prefetch = num_to_prefetch
 
     self.managed_layers = set(['seg'])
     self.todo = []  # items are maps from layer name to lists of segment IDs
-    if objects is not None:
-      self._set_todo(objects)
+    self._layer_todo = {}  # layer name -> per-item lists of segment IDs
+    self._layer_todo_set = {}  # same as above, with frozensets
+    # (index, batch, layer) -> tuple of segment IDs, for batch > 1 and indices
+    # within the current prefetch window only
+    self._seg_cache = {}
+    self._prefetch_generation = 0
+    self._pending_update = None  # threading.Timer for debounced navigation
+    self._pending_update_lock = threading.Lock()
+    # Held while viewer state changes are being applied. Reentrant so that
+    # navigation updates can be applied as part of other state changes.
+    self._update_lock = threading.RLock()
+    self._set_todo(objects if objects is not None else ())
 
     self.index = 0
     self.batch = 1
@@ -56,6 +72,7 @@ class Base:
     self.set_init_state()
 
   def _set_todo(self, objects):
+    self._seg_cache.clear()
     for o in objects:
       if isinstance(o, collections.abc.Mapping):
         self.todo.append(o)
@@ -65,30 +82,65 @@ class Base:
       else:
         self.todo.append({'seg': [o]})
 
+    # Per-layer view of `todo`, with items lacking a layer mapped to empty
+    # lists. This is what the navigation code reads from.
+    self._layer_todo = {
+        layer: [list(x.get(layer, ())) for x in self.todo]
+        for layer in self.managed_layers
+    }
+    self._layer_todo_set = {
+        layer: [frozenset(x) for x in todo]
+        for layer, todo in self._layer_todo.items()
+    }
+
   def set_init_state(self):
     raise NotImplementedError()
 
+  def _register_actions(self):
+    for action, method in self._ACTIONS:
+      self.viewer.actions.add(action, lambda s, m=getattr(self, method): m())
+
+  def _snapshot_state(self):
+    """Returns a mutable copy of the current viewer state.
+
+    Wrapping the JSON representation is much cheaper than deep-copying the
+    state object, and the wrappers do not write back to the source JSON.
+    """
+    return neuroglancer.ViewerState(self.viewer.state.to_json())
+
+  @contextlib.contextmanager
+  def _state_txn(self):
+    """Yields a snapshot of the viewer state and commits it on exit.
+
+    All read-modify-write updates of the viewer state need to go through
+    this, as debounced navigation updates are applied from a timer thread.
+    """
+    with self._update_lock:
+      s = self._snapshot_state()
+      yield s
+      self.viewer.set_state(s)
+
   def update_msg(self, msg):
     with self.viewer.config_state.txn() as s:
       s.status_messages['status'] = msg
 
-  def update_segments(self, segments, loc=None, layer='seg'):
-    s = copy.deepcopy(self.viewer.state)
-    l = s.layers[layer]
+  def _apply_segments(self, state, segments, loc=None, layer='seg'):
+    """Updates `state` in place to show `segments` in `layer`."""
+    l = state.layers[layer]
     l.segments = segments
 
-    if not self.apply_equivs:
-      l.equivalences.clear()
-    else:
-      l.equivalences.clear()
-      for a in self.todo[self.index : self.index + self.batch]:
-        a = [aa[layer] for aa in a]
+    l.equivalences.clear()
+    if self.apply_equivs:
+      todo = self._layer_todo_set[layer]
+      for a in todo[self.index : self.index + self.batch]:
         l.equivalences.union(*a)
 
     if loc is not None:
-      s.position = loc
+      state.position = loc
 
-    self.viewer.set_state(s)
+  def update_segments(self, segments, loc=None, layer='seg'):
+    with self._state_txn() as s:
+      self._apply_segments(s, segments, loc, layer=layer)
 
   def toggle_equiv(self):
     self.apply_equivs = not self.apply_equivs
@@ -97,57 +149,167 @@ class Base:
   def batch_dec(self):
     self.batch //= 2
     self.batch = max(self.batch, 1)
+    self._seg_cache.clear()
+    self._cancel_prefetch()
     self.update_batch()
 
   def batch_inc(self):
     self.batch *= 2
+    self._seg_cache.clear()
+    self._cancel_prefetch()
     self.update_batch()
 
   def next_batch(self):
     self.index += self.batch
     self.index = min(self.index, len(self.todo) - 1)
-    self.prefetch()
-    self.update_batch()
+    self._trim_seg_cache()
+    self._schedule_update()
 
   def prev_batch(self):
     self.index -= self.batch
     self.index = max(0, self.index)
-    self.update_batch()
+    self._trim_seg_cache()
+    self._schedule_update()
+
+  def _trim_seg_cache(self):
+    """Evicts cached segment lists outside of the current prefetch window."""
+    end = self.index + (self.num_to_prefetch + 1) * self.batch
+    for key in list(self._seg_cache):
+      if not self.index <= key[0] < end:
+        self._seg_cache.pop(key, None)
+
+  def _schedule_update(self):
+    """Updates the viewer after a short delay.
+
+    The index is updated right away by the callers, but the viewer state is
+    only materialized for the last of a quick series of navigation actions
+    (e.g. when a navigation key is held down). The update, including
+    prefetching, runs on the timer thread and so does not block the handling
+    of further user actions. Actions which read the current item or the
+    displayed segments need to call `_flush_pending_update` first.
+    """
+    with self._pending_update_lock:
+      if self._pending_update is not None:
+        self._pending_update.cancel()
+      self._pending_update = threading.Timer(
+          NAVIGATION_DEBOUNCE_SEC, self._flush_update
+      )
+      self._pending_update.daemon = True
+      self._pending_update.start()
+
+  def _flush_update(self):
+    with self._update_lock:
+      with self._pending_update_lock:
+        # Only clear the reference if no newer update was scheduled since
+        # this timer fired.
+        if self._pending_update is threading.current_thread():
+          self._pending_update = None
+      self.update_batch(prefetch=True)
+
+  def _flush_pending_update(self):
+    """Makes the viewer show the current item before acting on it.
+
+    Applies a scheduled navigation update right away, and waits for one
+    already in progress to complete.
+    """
+    with self._update_lock:
+      with self._pending_update_lock:
+        pending, self._pending_update = self._pending_update, None
+      if pending is not None:
+        pending.cancel()
+        self.update_batch()
 
   def list_segments(self, index=None, layer='seg'):
     if index is None:
       index = self.index
-    return list(
-        set(
-            itertools.chain(
-                *[x[layer] for x in self.todo[index : index + self.batch]]
-            )
-        )
-    )
+
+    batch = self.batch
+    todo = self._layer_todo[layer]
+    if batch == 1:
+      return list(todo[index])
+
+    key = (index, batch, layer)
+    segments = self._seg_cache.get(key)
+    if segments is None:
+      segments = tuple(set().union(*todo[index : index + batch]))
+      self._seg_cache[key] = segments
+    return list(segments)
 
   def custom_msg(self):
     return ''
 
-  def update_batch(self, update=True):
-    if self.batch == 1 and self.locations is not None:
-      loc = self.locations[self.index]
+  def _batch_msg(self):
+    return 'index:%d/%d  batch:%d  %s' % (
+        self.index,
+        len(self.todo),
+        self.batch,
+        self.custom_msg(),
+    )
+
+  def update_batch(self, update=True, prefetch=False):
+    if self.batch == 1:
+      self._update_batch_single()
     else:
-      loc = None
+      with self._state_txn() as s:
+        for layer in self.managed_layers:
+          self._apply_segments(s, self.list_segments(layer=layer), layer=layer)
 
-    for layer in self.managed_layers:
-      self.update_segments(self.list_segments(layer=layer), loc, layer=layer)
-    self.update_msg(
-        'index:%d/%d  batch:%d  %s'
-        % (self.index, len(self.todo), self.batch, self.custom_msg())
-    )
+    self._update_config(prefetch)
+
+  def _update_batch_single(self):
+    """Specialization of `update_batch` for batch == 1.
+
+    This is the common case during review, in which the current item's
+    segments can be used directly without going through `list_segments`.
+    """
+    with self._state_txn() as s:
+      for layer in self.managed_layers:
+        todo = self._layer_todo[layer]
+        self._apply_segments(s, todo[self.index], layer=layer)
+
+      if self.locations is not None:
+        s.position = self.locations[self.index]
+
+  def _update_config(self, prefetch=False):
+    """Sets the status message and prefetch list in a single transaction."""
+    prefetch_states = self.prefetch() if prefetch else None
+    with self.viewer.config_state.txn() as s:
+      s.status_messages['status'] = self._batch_msg()
+      if prefetch_states is not None:
+        s.prefetch = prefetch_states
+
+  def _cancel_prefetch(self):
+    self._prefetch_generation += 1
 
   def prefetch(self):
+    """Builds prefetch states for the batches following the current one.
+
+    A call is superseded by any later call (including the one made by a
+    debounced navigation update on the timer thread) or by a batch size
+    change made while it is in progress. Callers must handle a None result,
+    e.g. by leaving the viewer's prefetch list unchanged.
+
+    Returns:
+      list of neuroglancer.PrefetchState, or None if prefetching is disabled
+      or the computation was superseded by a newer call
+    """
+    if self.num_to_prefetch == 0:
+      return None
+
+    self._prefetch_generation += 1
+    generation = self._prefetch_generation
+    index, batch = self.index, self.batch
+
+    template = self.viewer.state.to_json()
     prefetch_states = []
     for i in range(self.num_to_prefetch):
-      idx = self.index + (i + 1) * self.batch
+      idx = index + (i + 1) * batch
       if idx >= len(self.todo):
         break
-      prefetch_state = copy.deepcopy(self.viewer.state)
+      if generation != self._prefetch_generation:
+        return None
+
+      prefetch_state = neuroglancer.ViewerState(template)
       for layer in self.managed_layers:
         prefetch_state.layers[layer].segments = self.list_segments(
             idx, layer=layer
@@ -158,11 +320,13 @@ class Base:
 
       prefetch_states.append(prefetch_state)
 
-    with self.viewer.config_state.txn() as s:
-      s.prefetch = [
-          neuroglancer.PrefetchState(state=prefetch_state, priority=-i)
-          for i, prefetch_state in enumerate(prefetch_states)
-      ]
+    if generation != self._prefetch_generation:
+      return None
+
+    return [
+        neuroglancer.PrefetchState(state=prefetch_state, priority=-i)
+        for i, prefetch_state in enumerate(prefetch_states)
+    ]
 
 
 class ObjectReview(Base):
@@ -172,6 +336,16 @@ class ObjectReview(Base):
   batches.
   """
 
+  _ACTIONS = (
+      ('next-batch', 'next_batch'),
+      ('prev-batch', 'prev_batch'),
+      ('dec-batch', 'batch_dec'),
+      ('inc-batch', 'batch_inc'),
+      ('mark-bad', 'mark_bad'),
+      ('mark-removed-bad', 'mark_removed_bad'),
+      ('toggle-equiv', 'toggle_equiv'),
+  )
+
   def __init__(self, objects, bad, num_to_prefetch=10, locations=None):
     """Constructor.
 
@@ -190,15 +364,7 @@ class ObjectReview(Base):
     )
     self.bad = bad
 
-    self.viewer.actions.add('next-batch', lambda s: self.next_batch())
-    self.viewer.actions.add('prev-batch', lambda s: self.prev_batch())
-    self.viewer.actions.add('dec-batch', lambda s: self.batch_dec())
-    self.viewer.actions.add('inc-batch', lambda s: self.batch_inc())
-    self.viewer.actions.add('mark-bad', lambda s: self.mark_bad())
-    self.viewer.actions.add(
-        'mark-removed-bad', lambda s: self.mark_removed_bad()
-    )
-    self.viewer.actions.add('toggle-equiv', lambda s: self.toggle_equiv())
+    self._register_actions()
 
     with self.viewer.config_state.txn() as s:
       s.input_event_bindings.viewer['keyj'] = 'next-batch'
@@ -215,13 +381,14 @@ class ObjectReview(Base):
     return 'num_bad: %d' % len(self.bad)
 
   def mark_bad(self):
+    self._flush_pending_update()
     if self.batch > 1:
       self.update_msg('decrease batch to 1 to mark objects bad')
       return
 
-    sids = self.todo[self.index]['seg']
+    sids = self._layer_todo['seg'][self.index]
     if len(sids) == 1:
-      self.bad.add(list(sids)[0])
+      self.bad.add(sids[0])
     else:
       self.bad.add(frozenset(sids))
 
@@ -229,8 +396,13 @@ class ObjectReview(Base):
     self.next_batch()
 
   def mark_removed_bad(self):
-    original = set(self.list_segments())
-    new_bad = original - set(self.viewer.state.layers['seg'].segments)
+    self._flush_pending_update()
+    if self.batch == 1:
+      original = self._layer_todo_set['seg'][self.index]
+    else:
+      todo = self._layer_todo_set['seg']
+      original = frozenset().union(*todo[self.index : self.index + self.batch])
+    new_bad = original.difference(self.viewer.state.layers['seg'].segments)
     if new_bad:
       self.bad |= new_bad
       self.update_msg('marked bad: %r' % (new_bad,))
@@ -239,6 +411,12 @@ class ObjectReview(Base):
 class ObjectClassification(Base):
   """Base class for object classification."""
 
+  _ACTIONS = (
+      ('mr-next-batch', 'next_batch'),
+      ('mr-prev-batch', 'prev_batch'),
+      ('unclassify', 'unclassify'),
+  )
+
   def __init__(self, objects, key_to_class, num_to_prefetch=10, locations=None):
     """Constructor.
 
@@ -253,9 +431,7 @@ class ObjectClassification(Base):
 
     self.results = defaultdict(set)  # class -> ids
 
-    self.viewer.actions.add('mr-next-batch', lambda s: self.next_batch())
-    self.viewer.actions.add('mr-prev-batch', lambda s: self.prev_batch())
-    self.viewer.actions.add('unclassify', lambda s: self.classify(None))
+    self._register_actions()
 
     for key, cls in key_to_class.items():
       self.viewer.actions.add(
@@ -277,15 +453,19 @@ class ObjectClassification(Base):
     return ' '.join('%s:%d' % (k, len(v)) for k, v in self.results.items())
 
   def classify(self, cls):
-    sid = list(self.todo[self.index]['seg'])[0]
+    self._flush_pending_update()
+    sid = self._layer_todo['seg'][self.index][0]
     for v in self.results.values():
-      v -= set([sid])
+      v.discard(sid)
 
     if cls is not None:
       self.results[cls].add(sid)
 
     self.next_batch()
 
+  def unclassify(self):
+    self.classify(None)
+
 
 class GraphUpdater(Base):
   """Base class for agglomeration graph modification.
@@ -309,25 +489,33 @@ class GraphUpdater(Base):
   (according to the current state of the agglomeraton graph).
   """
 
+  _ACTIONS = (
+      ('add-ccs', 'add_ccs'),
+      ('clear-splits', 'clear_splits'),
+      ('accept-split', 'accept_split'),
+      ('split-inc', 'inc_split'),
+      ('split-dec', 'dec_split'),
+      ('merge-segments', 'merge_segments'),
+      ('mark-bad', 'mark_bad'),
+      ('next-batch', 'next_batch'),
+      ('prev-batch', 'prev_batch'),
+  )
+
   def __init__(self, graph, objects, bad, num_to_prefetch=0):
     super().__init__(objects=objects, num_to_prefetch=num_to_prefetch)
     self.graph = graph
+    self._graph_ccs = {}  # node -> connected component ID
+    self._ccs = {}  # connected component ID -> frozenset of nodes
+    self._next_cc_id = 0
     self.split_objects = []
     self.split_path = []
     self.split_index = 1
     self.sem = threading.Semaphore()
 
     self.bad = bad
-    self.viewer.actions.add('add-ccs', lambda s: self.add_ccs())
-    self.viewer.actions.add('clear-splits', lambda s: self.clear_splits())
+    self._register_actions()
+    # Needs the action state to read the selected supervoxel.
     self.viewer.actions.add('add-split', self.add_split)
-    self.viewer.actions.add('accept-split', lambda s: self.accept_split())
-    self.viewer.actions.add('split-inc', lambda s: self.inc_split())
-    self.viewer.actions.add('split-dec', lambda s: self.dec_split())
-    self.viewer.actions.add('merge-segments', lambda s: self.merge_segments())
-    self.viewer.actions.add('mark-bad', lambda s: self.mark_bad())
-    self.viewer.actions.add('next-batch', lambda s: self.next_batch())
-    self.viewer.actions.add('prev-batch', lambda s: self.prev_batch())
 
     with self.viewer.config_state.txn() as s:
       s.input_event_bindings.viewer['keyj'] = 'next-batch'
@@ -348,13 +536,26 @@ class GraphUpdater(Base):
       s.layers['split'].visible = False
 
   def merge_segments(self):
-    sids = [sid for sid in self.viewer.state.layers['seg'].segments if sid > 0]
+    self._flush_pending_update()
+    sids = np.fromiter(
+        self.viewer.state.layers['seg'].segments, dtype=np.uint64
+    )
+    sids = sids[sids > 0].tolist()
     self.graph.add_edges_from(zip(sids, sids[1:]))
+    self._invalidate_ccs(sids)
+
+  def _invalidate_ccs(self, nodes):
+    """Forgets the cached components containing any of `nodes`."""
+    for n in nodes:
+      cc_id = self._graph_ccs.get(n)
+      if cc_id is None:
+        continue
+      for m in self._ccs.pop(cc_id):
+        del self._graph_ccs[m]
 
   def update_split(self):
-    s = copy.deepcopy(self.viewer.state)
-    s.layers['split'].segments = list(self.split_path)[: self.split_index]
-    self.viewer.set_state(s)
+    with self._state_txn() as s:
+      s.layers['split'].segments = list(self.split_path)[: self.split_index]
 
   def inc_split(self):
     self.split_index = min(len(self.split_path), self.split_index + 1)
@@ -365,13 +566,32 @@ class GraphUpdater(Base):
     self.update_split()
 
   def add_ccs(self):
-    if self.sem.acquire(blocking=False):
-      curr = set(self.viewer.state.layers['seg'].segments)
-      for sid in self.viewer.state.layers['seg'].segments:
-        if sid in self.graph:
-          curr |= set(nx.node_connected_component(self.graph, sid))
+    import networkx as nx
 
-      self.update_segments(curr)
+    self._flush_pending_update()
+    if self.sem.acquire(blocking=False):
+      # Components are only computed for selected nodes not covered by
+      # the cache, and reused until the graph is modified around them.
+      segments = self.viewer.state.layers['seg'].segments
+      cc_ids = set()
+      for sid in segments:
+        cc_id = self._graph_ccs.get(sid)
+        if cc_id is None:
+          if sid not in self.graph:
+            continue
+          cc = frozenset(nx.node_connected_component(self.graph, sid))
+          cc_id = self._next_cc_id
+          self._next_cc_id += 1
+          self._ccs[cc_id] = cc
+          for n in cc:
+            self._graph_ccs[n] = cc_id
+        cc_ids.add(cc_id)
+
+      curr = set(segments).union(*(self._ccs[i] for i in cc_ids))
+
+      # Nothing to do if the selection already consists of complete components.
+      if len(curr) > len(segments):
+        self.update_segments(curr)
       self.sem.release()
 
   def accept_split(self):
@@ -380,28 +600,29 @@ class GraphUpdater(Base):
       return
 
     self.graph.remove_edge(edge[0], edge[1])
+    self._invalidate_ccs(edge)
     self.clear_splits()
 
   def clear_splits(self):
     self.split_objects = []
     self.update_msg('splits cleared')
 
-    s = copy.deepcopy(self.viewer.state)
-    s.layers['split'].visible = False
-    s.layers['seg'].visible = True
-    self.viewer.set_state(s)
+    with self._state_txn() as s:
+      s.layers['split'].visible = False
+      s.layers['seg'].visible = True
 
   def start_split(self):
-    self.split_path = nx.shortest_path(
+    import networkx as nx
+
+    self.split_path = nx.bidirectional_shortest_path(
         self.graph, self.split_objects[0], self.split_objects[1]
     )
     self.split_index = 1
     self.update_msg('splitting: %s' % '-'.join(str(x) for x in self.split_path))
 
-    s = copy.deepcopy(self.viewer.state)
-    s.layers['seg'].visible = False
-    s.layers['split'].visible = True
-    self.viewer.set_state(s)
+    with self._state_txn() as s:
+      s.layers['seg'].visible = False
+      s.layers['split'].visible = True
     self.update_split()
 
   def add_split(self, s):
@@ -413,13 +634,14 @@ class GraphUpdater(Base):
       self.start_split()
 
   def mark_bad(self):
+    self._flush_pending_update()
     if self.batch > 1:
       self.update_msg('decrease batch to 1 to mark objects bad')
       return
 
-    sids = self.todo[self.index]['seg']
+    sids = self._layer_todo['seg'][self.index]
     if len(sids) == 1:
-      self.bad.add(list(sids)[0])
+      self.bad.add(sids[0])
     else:
       self.bad.add(frozenset(sids))
 
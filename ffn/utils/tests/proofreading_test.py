@@ -0,0 +1,199 @@
+# coding=utf-8
+# Copyright 2023 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+import threading
+import time
+from unittest import mock
+
+from absl.testing import absltest
+from ffn.utils import proofreading
+import networkx as nx
+import neuroglancer
+
+
+def _init_seg_layer(viewer):
+  with viewer.txn() as s:
+    s.layers['seg'] = neuroglancer.SegmentationLayer(
+        source='precomputed://gs://bucket/seg'
+    )
+
+
+class _Review(proofreading.ObjectReview):
+
+  def set_init_state(self):
+    _init_seg_layer(self.viewer)
+
+
+class _GraphUpdater(proofreading.GraphUpdater):
+
+  def set_init_state(self):
+    _init_seg_layer(self.viewer)
+
+
+class ProofreadingTest(absltest.TestCase):
+
+  def test_list_segments(self):
+    r = _Review([[1, 2], 3, [4, 5]], set(), num_to_prefetch=0)
+    self.assertCountEqual(r.list_segments(), [1, 2])
+
+    # Mutating the result must not affect later calls.
+    r.list_segments().append(100)
+    self.assertCountEqual(r.list_segments(), [1, 2])
+
+    r.batch_inc()
+    self.assertCountEqual(r.list_segments(), [1, 2, 3])
+    self.assertCountEqual(r.list_segments(1), [3, 4, 5])
+    r.list_segments(1).clear()
+    self.assertCountEqual(r.list_segments(1), [3, 4, 5])
+
+    # Navigation evicts cached batches, which are then rebuilt on demand.
+    r.next_batch()
+    r.prev_batch()
+    r._flush_pending_update()
+    self.assertCountEqual(r.list_segments(), [1, 2, 3])
+    self.assertCountEqual(r.list_segments(1), [3, 4, 5])
+
+  def test_equivalences(self):
+    r = _Review([[1, 2], [3, 4]], set(), num_to_prefetch=0)
+
+    def equivs():
+      return r.viewer.state.layers['seg'].equivalences.to_json()
+
+    self.assertEqual(equivs(), [])
+
+    r.toggle_equiv()
+    self.assertEqual(equivs(), [[1, 2]])
+    r.batch_inc()
+    self.assertCountEqual(equivs(), [[1, 2], [3, 4]])
+    r.toggle_equiv()
+    self.assertEqual(equivs(), [])
+
+  def test_actions_after_navigation(self):
+    # Actions issued before the debounced navigation update fires have to
+    # apply to the item they are about to see, not to the previous one.
+    bad = set()
+    r = _Review([[1, 2], [11, 12], [21]], bad, num_to_prefetch=1)
+    r.next_batch()
+    r.mark_removed_bad()
+    self.assertEqual(bad, set())
+    self.assertEqual(set(r.viewer.state.layers['seg'].segments), {11, 12})
+
+    r.mark_bad()
+    self.assertEqual(bad, {frozenset([11, 12])})
+    r.prev_batch()
+    r.prev_batch()
+    r.mark_bad()
+    self.assertEqual(bad, {frozenset([11, 12]), frozenset([1, 2])})
+
+    graph = nx.Graph()
+    graph.add_edges_from([(1, 2), (11, 12)])
+    g = _GraphUpdater(graph, [1, 11], set())
+    g.next_batch()
+    g.add_ccs()
+    self.assertEqual(set(g.viewer.state.layers['seg'].segments), {11, 12})
+
+  def test_split_during_navigation_update(self):
+    graph = nx.Graph()
+    graph.add_edges_from([(1, 2), (2, 3)])
+    g = _GraphUpdater(graph, [1, 2], set())
+
+    # Slow down the debounced navigation update so that the split is
+    # started while it is in progress.
+    applying = threading.Event()
+    apply_segments = g._apply_segments
+
+    def slow_apply_segments(*args, **kwargs):
+      applying.set()
+      time.sleep(0.2)
+      apply_segments(*args, **kwargs)
+
+    g._apply_segments = slow_apply_segments
+    g.next_batch()
+    self.assertTrue(applying.wait(5))
+    g.split_objects = [1, 3]
+    g.start_split()
+    g._flush_pending_update()
+
+    state = g.viewer.state
+    self.assertEqual(set(state.layers['seg'].segments), {2})
+    self.assertFalse(state.layers['seg'].visible)
+    self.assertTrue(state.layers['split'].visible)
+    self.assertEqual(list(state.layers['split'].segments), [1])
+
+  def test_prefetch_follows_view(self):
+    r = _Review([1, 2, 3, 4], set(), num_to_prefetch=2)
+    states = r.prefetch()
+    self.assertEqual(
+        [list(p.state.layers['seg'].segments) for p in states], [[2], [3]]
+    )
+
+    with r.viewer.txn() as s:
+      s.cross_section_scale = 7.0
+    r.next_batch()
+    # Apply the navigation update right away, so that the debounce timer
+    # cannot supersede the prefetch below.
+    r._flush_pending_update()
+    states = r.prefetch()
+    self.assertEqual(
+        [list(p.state.layers['seg'].segments) for p in states], [[3], [4]]
+    )
+    for p in states:
+      self.assertEqual(p.state.cross_section_scale, 7.0)
+      self.assertEqual(p.state.layout.type, '3d')
+
+  def test_add_ccs(self):
+    graph = nx.Graph()
+    graph.add_edges_from([(1, 2), (2, 3), (10, 11), (20, 21)])
+    g = _GraphUpdater(graph, [1], set())
+
+    def select(segments):
+      with g.viewer.txn() as s:
+        s.layers['seg'].segments = segments
+
+    def add_ccs():
+      """Runs add_ccs and returns the selection and the number of BFS runs."""
+      with mock.patch.object(
+          nx, 'node_connected_component', wraps=nx.node_connected_component
+      ) as cc_mock:
+        g.add_ccs()
+      return set(g.viewer.state.layers['seg'].segments), cc_mock.call_count
+
+    select([1, 10, 30])
+    self.assertEqual(add_ccs(), ({1, 2, 3, 10, 11, 30}, 2))
+    # Already complete components need no graph traversal.
+    self.assertEqual(add_ccs(), ({1, 2, 3, 10, 11, 30}, 0))
+
+    select([3, 20])
+    g.merge_segments()
+    select([1])
+    self.assertEqual(add_ccs(), ({1, 2, 3, 20, 21}, 1))
+    # Components not touched by the merge are reused.
+    select([10])
+    self.assertEqual(add_ccs(), ({10, 11}, 0))
+
+    g.split_path = [1, 2, 3]
+    g.split_index = 1
+    g.accept_split()
+    self.assertFalse(graph.has_edge(1, 2))
+    select([1])
+    self.assertEqual(add_ccs(), ({1}, 1))
+    select([2])
+    self.assertEqual(add_ccs(), ({2, 3, 20, 21}, 1))
+    select([11])
+    self.assertEqual(add_ccs(), ({10, 11}, 0))
+
+if __name__ == '__main__':
+  absltest.main()